@@ -1,7 +1,5 @@
-import logging
-import sys
-
-# Import the base tracer that works on all Python versions
+# The tracer is based on sys.monitoring (PEP 669), importing it raises an
+# ImportError on Python < 3.12
 from .custom_sysmon import CodeMonitor
 
 
@@ -9,15 +7,6 @@ __all__ = ["CodeMonitor"]
 # Create a singleton instance for the module
 tracer = CodeMonitor()
 
-# Import the sys.monitoring-based tracer if Python 3.12+ is available
-if hasattr(sys, "monitoring"):
-    from .custom_sysmon import CodeMonitor
-
-    __all__.append("CodeMonitor")
-    tracer = CodeMonitor()
-else:
-    logging.warning("Python 3.12+ is required to use the sys.monitoring-based tracer.")
-
 
 def start_tracing() -> None:
     """Start tracing code execution."""
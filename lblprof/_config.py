@@ -0,0 +1,5 @@
+import os
+
+# The tracing callbacks and add_line_event run for every traced line, their debug logs
+# are only built and emitted when LBLPROF_DEBUG is set
+_DEBUG = bool(os.environ.get("LBLPROF_DEBUG"))
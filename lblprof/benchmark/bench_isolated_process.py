@@ -1,15 +1,13 @@
-"""This script is run in an isolated process to benchmark the overhead of lblprof.
-It takes as arguments the module name, function name, and mode (profiled or unprofiled)"""
+"""This module runs a benchmark function in an isolated process to measure the overhead of lblprof.
+It is used by benchmark_overhead.py in its worker processes, and can also be run as a script
+taking as arguments the module name, function name, and mode (profiled or unprofiled)"""
 
-if __name__ == "__main__":
-    import sys
-    import time
-    import json
-    import importlib
+import importlib
+import time
 
-    # args: module function mode
-    module, func_name, mode = sys.argv[1], sys.argv[2], sys.argv[3]
 
+def run_benchmark(module: str, func_name: str, mode: str) -> float:
+    """Run the function once and return the time taken."""
     mod = importlib.import_module(module)
     fn = getattr(mod, func_name)
 
@@ -23,5 +21,14 @@ if __name__ == "__main__":
     else:
         fn()
     end = time.perf_counter()
+    return end - start
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+
+    # args: module function mode
+    module, func_name, mode = sys.argv[1], sys.argv[2], sys.argv[3]
 
-    print(json.dumps({"time": end - start}))
+    print(json.dumps({"time": run_benchmark(module, func_name, mode)}))
@@ -1,7 +1,7 @@
-import subprocess
-import sys
-import json
+import multiprocessing
+import multiprocessing.pool
 from typing import Literal
+from lblprof.benchmark.bench_isolated_process import run_benchmark
 from lblprof.benchmark.funcs import sample_functions
 import logging
 
@@ -11,19 +11,11 @@ logging.basicConfig(level=logging.INFO, force=True)
 BenchRunMode = Literal["profiled", "unprofiled"]
 
 
-def run(module: str, fn: str, mode: BenchRunMode) -> float:
-    """Run the isolated benchmark process and return the time taken."""
-    process_script_path = "lblprof/benchmark/bench_isolated_process.py"
-    r = subprocess.check_output(
-        [
-            sys.executable,
-            process_script_path,
-            module,
-            fn,
-            mode,
-        ]
-    )
-    return json.loads(r)["time"]
+def run(
+    pool: multiprocessing.pool.Pool, module: str, fn: str, mode: BenchRunMode
+) -> float:
+    """Run the benchmark in an isolated process and return the time taken."""
+    return pool.apply(run_benchmark, (module, fn, mode))
 
 
 def print_bench_result(
@@ -41,16 +33,23 @@ def print_bench_result(
     print()
 
 
-for func in sample_functions:
-    module = func.__module__
-    fn = func.__name__
-    number_of_runs = 10
-    profiled_times: list[float] = []
-    unprofiled_times: list[float] = []
-    for _ in range(number_of_runs):
-        t_profiled = run(module, fn, "profiled")
-        t_unprofiled = run(module, fn, "unprofiled")
-        profiled_times.append(t_profiled)
-        unprofiled_times.append(t_unprofiled)
-
-    print_bench_result(unprofiled_times=unprofiled_times, profiled_times=profiled_times)
+if __name__ == "__main__":
+    # Each run is executed in a new worker process (maxtasksperchild=1) so runs don't share
+    # imported modules or tracer state. The pool uses the platform's default start method,
+    # with fork (Linux) the workers don't pay the interpreter startup of a subprocess
+    with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+        for func in sample_functions:
+            module = func.__module__
+            fn = func.__name__
+            number_of_runs = 10
+            profiled_times: list[float] = []
+            unprofiled_times: list[float] = []
+            for _ in range(number_of_runs):
+                t_profiled = run(pool, module, fn, "profiled")
+                t_unprofiled = run(pool, module, fn, "unprofiled")
+                profiled_times.append(t_profiled)
+                unprofiled_times.append(t_unprofiled)
+
+            print_bench_result(
+                unprofiled_times=unprofiled_times, profiled_times=profiled_times
+            )
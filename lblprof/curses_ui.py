@@ -1,5 +1,5 @@
 import curses
-from typing import Callable, List, Optional, TypedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple, TypedDict
 
 from lblprof.line_stat_object import LineStats
 
@@ -9,6 +9,8 @@ class NodeTerminalUI(TypedDict):
     depth: int
     is_last: bool
     has_children: bool
+    # Tree prefix drawn before the node (branches of its ancestors and its own branch)
+    prefix: str
 
 
 class TerminalTreeUI:
@@ -36,78 +38,95 @@ class TerminalTreeUI:
         self.space = "    "
 
         # UI state
-        self.expanded_nodes = set()  # Keys of expanded nodes (instead of collapsed)
+        # Ids of the expanded lines (instead of collapsed), it is checked for every displayed
+        # node, an int id hashes in O(1) where a (line, stack trace) key hashes its whole stack trace
+        self.expanded_nodes: Set[int] = set()
         self.current_pos = 0  # Current selected position
         self.scroll_offset = 0  # Vertical scroll offset
 
+        # Sorted children of each node already displayed, keyed by line id
+        # The tree doesn't change while the UI runs, so they are computed once per node
+        self._sorted_children: Dict[int, List[LineStats]] = {}
+
     def _generate_display_data(
         self, root_nodes: List[LineStats]
     ) -> List[NodeTerminalUI]:
         """Generate flattened display data based on current UI state."""
+        # Nodes to display, as (line, depth, is_last, ancestors_prefix)
+        # ancestors_prefix is the part of the prefix drawn for the ancestors of the node,
+        # a pipe for each ancestor that has siblings below it and a space otherwise
+        stack: List[Tuple[LineStats, int, bool, str]] = [
+            (root_nodes[i], 0, i == len(root_nodes) - 1, "")
+            for i in reversed(range(len(root_nodes)))
+        ]
+        return self._flatten_nodes(stack)
+
+    def _flatten_nodes(
+        self, stack: List[Tuple[LineStats, int, bool, str]]
+    ) -> List[NodeTerminalUI]:
+        """Flatten the nodes of the stack and their expanded descendants in display order."""
         display_data: List[NodeTerminalUI] = []
 
-        # Process each root node
-        for i, root in enumerate(root_nodes):
-            is_last_root = i == len(root_nodes) - 1
+        # We use an explicit stack instead of recursion, the children of a node are pushed
+        # in reverse order so they are displayed in order (DFS pre-order)
+        while stack:
+            line, depth, is_last, ancestors_prefix = stack.pop()
 
             node_data: NodeTerminalUI = {
-                "line": root,
-                "depth": 0,
-                "is_last": is_last_root,
-                "has_children": bool(root.childs),
+                "line": line,
+                "depth": depth,
+                "is_last": is_last,
+                "has_children": bool(line.childs),
+                "prefix": ancestors_prefix
+                + (self.branch_last if is_last else self.branch_mid),
             }
             display_data.append(node_data)
 
-            # Add children only if explicitly expanded
-            if root.event_key in self.expanded_nodes:
-                self._add_children_to_display(display_data, root, 1)
+            # Add the children only if explicitly expanded
+            if line.id in self.expanded_nodes:
+                self._push_children(
+                    stack,
+                    line,
+                    depth,
+                    ancestors_prefix + (self.space if is_last else self.pipe),
+                )
 
         return display_data
 
-    def _add_children_to_display(
-        self, display_data: List[NodeTerminalUI], parent: LineStats, depth: int
+    def _push_children(
+        self,
+        stack: List[Tuple[LineStats, int, bool, str]],
+        parent: LineStats,
+        depth: int,
+        children_prefix: str,
     ):
-        """Add children of a node to the display data recursively."""
-        # Get all child lines
+        """Push the children of a node at the given depth on the flattening stack."""
         child_lines = self._get_sorted_children(parent)
-
-        # Add each child to display data
-        for i, child in enumerate(child_lines):
+        for i in reversed(range(len(child_lines))):
             is_last_child = i == len(child_lines) - 1
-
-            node_data: NodeTerminalUI = {
-                "line": child,
-                "depth": depth,
-                "is_last": is_last_child,
-                "has_children": bool(child.childs),
-            }
-            display_data.append(node_data)
-
-            # Add child's children only if explicitly expanded
-            if child.event_key in self.expanded_nodes:
-                self._add_children_to_display(display_data, child, depth + 1)
+            stack.append((child_lines[i], depth + 1, is_last_child, children_prefix))
 
     def _get_sorted_children(self, parent: LineStats) -> List[LineStats]:
         """Get children of a parent node."""
+        cached_children = self._sorted_children.get(parent.id)
+        if cached_children is not None:
+            return cached_children
+
         # First get all valid children
         children = self.tree_data_provider(parent)
 
-        # Group children by file
-        children_by_file = {}
-        for child in children:
-            if child.file_name not in children_by_file:
-                children_by_file[child.file_name] = []
-            children_by_file[child.file_name].append(child)
-
-        # Sort each file's lines by line number
-        for file_name in children_by_file:
-            children_by_file[file_name].sort(key=lambda x: x.line_no)
-
-        # Flatten all children
-        all_children = []
-        for file_name in children_by_file:
-            all_children.extend(children_by_file[file_name])
+        # Sort the lines by line number, grouped by file in order of first appearance
+        # (a single stable sort on (file rank, line number))
+        file_ranks: Dict[str, int] = {}
+        all_children = sorted(
+            children,
+            key=lambda child: (
+                file_ranks.setdefault(child.file_name, len(file_ranks)),
+                child.line_no,
+            ),
+        )
 
+        self._sorted_children[parent.id] = all_children
         return all_children
 
     def _render_tree(self, stdscr, display_data: List[NodeTerminalUI], max_y, max_x):
@@ -130,6 +149,13 @@ class TerminalTreeUI:
             if i + 1 in root_spacers:
                 visible_items += 1  # Count the spacer
 
+        # Values used for every rendered node
+        current_pos = self.current_pos
+        expanded_nodes = self.expanded_nodes
+        node_formatter = self.node_formatter
+        normal_color = curses.color_pair(1)
+        selected_color = curses.color_pair(2)
+
         # Render the visible portion
         rendered_pos = 0
         for i in range(self.scroll_offset, visible_end):
@@ -144,29 +170,18 @@ class TerminalTreeUI:
             abs_pos = i
 
             # Color based on selection
-            color = (
-                curses.color_pair(2)
-                if abs_pos == self.current_pos
-                else curses.color_pair(1)
-            )
-
-            # Generate prefix based on depth and position
-            prefix = self._get_prefix(node, display_data)
+            color = selected_color if abs_pos == current_pos else normal_color
 
             # Get indicator for expandable nodes
             indicator = ""
             if node["has_children"]:
-                indicator = (
-                    "[+] "
-                    if node["line"].event_key not in self.expanded_nodes
-                    else "[-] "
-                )
+                indicator = "[+] " if node["line"].id not in expanded_nodes else "[-] "
 
             # Format the node using the provided formatter
-            line_text = self.node_formatter(node["line"], indicator)
+            line_text = node_formatter(node["line"], indicator)
 
             # Combine and truncate if needed
-            full_line = f"{prefix}{line_text}"
+            full_line = f"{node['prefix']}{line_text}"
             if len(full_line) >= max_x:
                 full_line = full_line[: max_x - 3] + "..."
 
@@ -175,48 +190,33 @@ class TerminalTreeUI:
             screen_y += 1
             rendered_pos += 1
 
-    def _get_prefix(self, node, display_data):
-        """Generate the tree prefix for a node based on its position in the hierarchy."""
-        prefix = ""
-        if node["depth"] == 0:
-            # Root nodes
-            return self.branch_last if node["is_last"] else self.branch_mid
-
-        # For each level of depth, determine if we need a pipe or space
-        for d in range(node["depth"] + 1):
-            if d == node["depth"]:
-                # Last level - add branch
-                prefix += self.branch_last if node["is_last"] else self.branch_mid
-            else:
-                # Find if any parent at this level is a last child
-                is_last_ancestor = self._check_if_last_ancestor(node, display_data, d)
-                prefix += self.space if is_last_ancestor else self.pipe
-
-        return prefix
-
-    def _check_if_last_ancestor(self, node, display_data, depth):
-        """Check if the node has an ancestor at the given depth that is the last child."""
-        # Find all nodes at this depth level
-        nodes_at_depth = [n for n in display_data if n["depth"] == depth]
-        if not nodes_at_depth:
-            return False
-
-        # Get the last node at this depth that appears before our target node
-        for n in reversed(nodes_at_depth):
-            if display_data.index(n) < display_data.index(node):
-                return n["is_last"]
-
-        return False
-
-    def _toggle_collapse(
-        self, display_data: List[NodeTerminalUI], current_node: NodeTerminalUI
-    ):
-        """Toggle collapse state of the current node."""
-        node_key = current_node["line"].event_key
+    def _toggle_collapse(self, display_data: List[NodeTerminalUI], node_index: int):
+        """Toggle collapse state of a node and update the display data in place."""
+        node = display_data[node_index]
+        node_key = node["line"].id
         if node_key in self.expanded_nodes:
             self.expanded_nodes.remove(node_key)
+            # Remove the displayed descendants of the node, they directly follow it
+            # and are deeper than it
+            end = node_index + 1
+            while (
+                end < len(display_data) and display_data[end]["depth"] > node["depth"]
+            ):
+                end += 1
+            del display_data[node_index + 1 : end]
         else:
             self.expanded_nodes.add(node_key)
+            # Insert the node's subtree after it, the prefix of its children is the
+            # prefix of the node with its branch replaced by a pipe or a space
+            stack: List[Tuple[LineStats, int, bool, str]] = []
+            self._push_children(
+                stack,
+                node["line"],
+                node["depth"],
+                node["prefix"][: -len(self.branch_last)]
+                + (self.space if node["is_last"] else self.pipe),
+            )
+            display_data[node_index + 1 : node_index + 1] = self._flatten_nodes(stack)
 
     def run(self):
         """Run the terminal UI."""
@@ -244,45 +244,60 @@ class TerminalTreeUI:
             "[↑/↓]: Navigate | [PgUp/PgDn]: Page | [Enter]: Expand/Collapse | [q]: Quit"
         )
 
+        # Flattened nodes currently displayed, updated in place when a node is expanded
+        # or collapsed instead of being rebuilt on every redraw
+        display_data = self._generate_display_data(root_nodes)
+
         # Main UI loop
         running = True
+        redraw = True
+        key = -1  # Key already waiting to be handled, -1 if there is none
         while running:
-            # Get terminal dimensions
-            max_y, max_x = stdscr.getmaxyx()
+            # The screen is only redrawn when the last keys changed something, and only once
+            # the keys already waiting (e.g. an arrow key held down) have all been handled
+            if redraw and key == -1:
+                # Get terminal dimensions
+                max_y, max_x = stdscr.getmaxyx()
 
-            # Adjust scroll_offset if window is resized to be smaller
-            visible_height = max_y - 4
-            display_data = self._generate_display_data(root_nodes)
-            if self.current_pos >= len(display_data):
-                self.current_pos = len(display_data) - 1 if display_data else 0
+                # Adjust scroll_offset if window is resized to be smaller
+                visible_height = max_y - 4
+                if self.current_pos >= len(display_data):
+                    self.current_pos = len(display_data) - 1 if display_data else 0
 
-            # Make sure current position is visible
-            if self.current_pos < self.scroll_offset:
-                self.scroll_offset = self.current_pos
-            elif self.current_pos >= self.scroll_offset + visible_height:
-                self.scroll_offset = max(0, self.current_pos - visible_height + 1)
+                # Make sure current position is visible
+                if self.current_pos < self.scroll_offset:
+                    self.scroll_offset = self.current_pos
+                elif self.current_pos >= self.scroll_offset + visible_height:
+                    self.scroll_offset = max(0, self.current_pos - visible_height + 1)
 
-            # Clear screen
-            stdscr.clear()
+                # Clear screen
+                # erase() only blanks the window buffer, refresh() then sends the cells that changed
+                # since the last frame, clear() would repaint the whole terminal on every frame
+                stdscr.erase()
 
-            # Display header
-            header = "LINE TRACE TREE"
-            stdscr.addstr(0, 0, header, curses.color_pair(3) | curses.A_BOLD)
-            stdscr.addstr(1, 0, "=" * len(header), curses.color_pair(3))
+                # Display header
+                header = "LINE TRACE TREE"
+                stdscr.addstr(0, 0, header, curses.color_pair(3) | curses.A_BOLD)
+                stdscr.addstr(1, 0, "=" * len(header), curses.color_pair(3))
 
-            # Display tree
-            self._render_tree(stdscr, display_data, max_y, max_x)
+                # Display tree
+                self._render_tree(stdscr, display_data, max_y, max_x)
 
-            # Display help
-            stdscr.addstr(max_y - 1, 0, help_text, curses.color_pair(3))
+                # Display help
+                stdscr.addstr(max_y - 1, 0, help_text, curses.color_pair(3))
 
-            # Refresh screen
-            stdscr.refresh()
+                # Refresh screen
+                stdscr.refresh()
+                redraw = False
 
             # Get user input
-            key = stdscr.getch()
+            if key == -1:
+                key = stdscr.getch()
 
             # Handle key presses
+            # Only the keys handled below (and a terminal resize) change what is displayed,
+            # the screen is left as is for any other key
+            changed = True
             if key == curses.KEY_UP:
                 # Move up
                 if self.current_pos > 0:
@@ -322,7 +337,21 @@ class TerminalTreeUI:
                 if self.current_pos < len(display_data):
                     current_node = display_data[self.current_pos]
                     if current_node["has_children"]:
-                        self._toggle_collapse(display_data, current_node)
+                        self._toggle_collapse(display_data, self.current_pos)
 
             elif key == ord("q"):  # Quit
                 running = False
+
+            elif key == curses.KEY_RESIZE:
+                # The queued keys are handled before the next redraw, the navigation
+                # keys that follow need the new terminal height
+                max_y, max_x = stdscr.getmaxyx()
+
+            else:
+                changed = False
+            redraw = redraw or changed
+
+            # Look for a key already waiting without blocking
+            stdscr.nodelay(True)
+            key = stdscr.getch()
+            stdscr.nodelay(False)
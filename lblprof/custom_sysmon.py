@@ -1,8 +1,12 @@
 import logging
+import os
+import re
 import sys
-import time
+import sysconfig
+from time import perf_counter_ns
 from types import CodeType
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+from ._config import _DEBUG
 from .line_stats_tree import LineStatsTree
 
 
@@ -10,6 +14,34 @@ from .line_stats_tree import LineStatsTree
 if not hasattr(sys, "monitoring"):
     raise ImportError("sys.monitoring is not available. This requires Python 3.12+")
 
+logger = logging.getLogger(__name__)
+
+# Path fragments that identify installed / built-in modules rather than user code
+NON_USER_CODE_PATHS = [
+    ".local/lib",
+    "/usr/lib",
+    "/usr/local/lib",
+    "site-packages",
+    "dist-packages",
+    "/lib/python3.12/",
+    "frozen",
+    ".local/share",
+    "/.vscode-server/",
+]
+
+# Install directories of the running interpreter (stdlib and site-packages)
+# Checked first with a single startswith call, most library files are under one of them
+_NON_USER_CODE_PREFIXES = ("<",) + tuple(
+    {
+        os.path.join(sysconfig.get_path(name), "")
+        for name in ("stdlib", "platstdlib", "purelib", "platlib")
+    }
+)
+
+# All the fragments are compiled in a single pattern so a filename is scanned once
+# instead of once per fragment
+_NON_USER_CODE_RE = re.compile("|".join(re.escape(p) for p in NON_USER_CODE_PATHS))
+
 
 class CodeMonitor:
     """
@@ -20,63 +52,114 @@ class CodeMonitor:
     done during the build_tree metho of the tree class
     """
 
-    def __init__(self):
+    # The callbacks read and write these attributes on every event, slots make them
+    # fixed offset loads / stores instead of instance dict lookups
+    __slots__ = (
+        "tool_id",
+        "call_stack",
+        "_stack_cache",
+        "_pushing_codes",
+        "tree",
+        "_add_line_event",
+        "tempo_line_infos",
+        "_user_code_cache",
+        "_code_infos",
+        "_instrumented_codes",
+        "_last_code",
+        "_last_line_keys",
+    )
+
+    def __init__(self) -> None:
         # Define a unique monitoring tool ID
         self.tool_id = sys.monitoring.PROFILER_ID
 
         # Call stack to store callers and keep track of the functions that called the current frame
-        self.call_stack: List[Tuple[str, str, int]] = []
+        # It is an immutable tuple, replaced on each call / return, so it can be given as is
+        # to all the events recorded until the stack changes
+        # Identical stacks are deduplicated through _stack_cache so a stack that comes back
+        # (e.g. a function called in a loop) is stored only once
+        self.call_stack: Tuple[Tuple[str, str, int], ...] = ()
+        self._stack_cache: Dict[
+            Tuple[Tuple[str, str, int], ...], Tuple[Tuple[str, str, int], ...]
+        ] = {(): ()}
+        # Code object of the frame that pushed each entry of the call stack
+        # Some frames don't push an entry (genexpr, frames called from a root line), so a
+        # returning frame only pops the call stack if it pushed its top entry
+        self._pushing_codes: List[CodeType] = []
 
         # Data structure to store the infos, insert should be quick during tracing, compute should be delayed at build time
         self.tree = LineStatsTree()
+        # Bound once so the callbacks don't look up the tree and its method on every event
+        self._add_line_event = self.tree.add_line_event
 
         # Use to store the line info until next line to keep track of who is the caller during call events
         self.tempo_line_infos: Tuple[str, str, int] | None = None
 
-        # We use this to store the overhead of the monitoring tool and deduce it from the total time
-        # The time of execution of the program will still be longer but at least the displayed time will be
-        # more accurate
-        self.overhead = 0
+        # Result of _is_user_code for each filename already seen, the check is done
+        # on every event but the set of filenames is small
+        self._user_code_cache: Dict[str, bool] = {}
+
+        # Infos computed once for each code object seen during tracing, keyed by id(code):
+        # (code, is_user_code, {line_no: (file_name, func_name, line_no)})
+        # The line keys are built once so the events of a line share the same tuple
+        # Keeping a reference to the code object makes sure its id is not reused
+        self._code_infos: Dict[
+            int, Tuple[CodeType, bool, Dict[int, Tuple[str, str, int]]]
+        ] = {}
+
+        # Code objects on which we already activated local events, keyed by id(code)
+        # Local events stay set on a code object, so we only need to do it on the first call
+        self._instrumented_codes: Dict[int, CodeType] = {}
 
-        # Total number of events, used to generate unique ids for each line
-        self.total_events = 0
+        # Last user code object seen by _handle_line and its line keys
+        self._last_code: CodeType | None = None
+        self._last_line_keys: Dict[int, Tuple[str, str, int]] = {}
 
-    def _handle_call(self, code: CodeType, instruction_offset: int):
+    def _handle_call(self, code: CodeType, instruction_offset: int) -> object:
         """Handle function call events"""
-        start = time.perf_counter()
-        file_name = code.co_filename
+        code_infos = self._code_infos.get(id(code))
+        if code_infos is None:
+            code_infos = self._add_code_infos(code)
+        _, is_user_code, _ = code_infos
 
-        if not self._is_user_code(file_name):
+        if not is_user_code:
             # The call is from an imported module, we deactivate monitoring for this function
-            if not sys.monitoring.get_tool(self.tool_id):
-                sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
-            sys.monitoring.set_local_events(self.tool_id, code, 0)
-            self.overhead += time.perf_counter() - start
-            return
+            # PY_START is a global event, DISABLE makes sys.monitoring stop calling us for
+            # this code object so we only pay for the first call of each library function
+            return sys.monitoring.DISABLE
 
+        file_name = code.co_filename
         func_name = code.co_name
         line_no = code.co_firstlineno
         # We entered a frame from user code, we activate monitoring for it
-        if not sys.monitoring.get_tool(self.tool_id):
-            sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
-        sys.monitoring.set_local_events(
-            self.tool_id,
-            code,
-            sys.monitoring.events.LINE
-            | sys.monitoring.events.PY_RETURN
-            | sys.monitoring.events.PY_START,
-        )
-
-        logging.debug(
-            f"handle call: filename: {file_name}, func_name: {func_name}, line_no: {line_no}"
-        )
+        if id(code) not in self._instrumented_codes:
+            if not sys.monitoring.get_tool(self.tool_id):
+                sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
+            sys.monitoring.set_local_events(
+                self.tool_id,
+                code,
+                sys.monitoring.events.LINE
+                | sys.monitoring.events.PY_RETURN
+                | sys.monitoring.events.PY_START
+                | sys.monitoring.events.PY_YIELD
+                | sys.monitoring.events.PY_RESUME,
+            )
+            self._instrumented_codes[id(code)] = code
+
+        if _DEBUG:
+            logger.debug(
+                "handle call: filename: %s, func_name: %s, line_no: %s",
+                file_name,
+                func_name,
+                line_no,
+            )
         if "<genexpr>" in func_name:
             return
         # We get info on who called the function
         # Using the tempo line infos instead of frame.f_back allows us to
         # get information about last parent that is from user code and not
         # from an imported / built in module
-        if not self.tempo_line_infos:
+        if self.tempo_line_infos is None:
             # Here we are called by a root line, so no caller in the stack
             return
 
@@ -87,84 +170,119 @@ class CodeMonitor:
         # Until we return from the function, all lines executed will have
         # the caller line as parent
 
-        self.call_stack.append(caller_key)
+        call_stack = self.call_stack + (caller_key,)
+        self.call_stack = self._stack_cache.setdefault(call_stack, call_stack)
+        self._pushing_codes.append(code)
 
-    def _handle_line(self, code: CodeType, line_number: int):
+    def _handle_line(self, code: CodeType, line_number: int) -> object:
         """Handle line execution events"""
-        now = time.perf_counter()
-
-        file_name = code.co_filename
-        func_name = code.co_name
-        line_no = line_number
-
-        if not self._is_user_code(file_name):
-            # The line is from an imported module, we deactivate monitoring for this line
-            self.overhead += time.perf_counter() - now
-            return
+        # Consecutive lines are most of the time in the same code object (loops, function bodies)
+        # so we keep the line keys of the last user code object to skip the code infos lookup
+        if code is self._last_code:
+            line_keys = self._last_line_keys
+        else:
+            code_infos = self._code_infos.get(id(code))
+            if code_infos is None:
+                code_infos = self._add_code_infos(code)
+            _, is_user_code, line_keys = code_infos
+
+            if not is_user_code:
+                # The line is from an imported module, we deactivate monitoring for this line
+                # DISABLE stops sys.monitoring from calling us again for this line
+                return sys.monitoring.DISABLE
+            self._last_code = code
+            self._last_line_keys = line_keys
+
+        now = perf_counter_ns()
+        line_key = line_keys.get(line_number)
+        if line_key is None:
+            # The names are interned so all the keys built from them share the same
+            # string objects, making their hashing and comparison in build_tree cheap
+            line_key = (
+                sys.intern(code.co_filename),
+                sys.intern(code.co_name),
+                line_number,
+            )
+            line_keys[line_number] = line_key
+        file_name, func_name, line_no = line_key
 
         # Add the line record to the tree
-        logging.debug(f"tracing line: {file_name} {func_name} {line_no}")
-        self.tree.add_line_event(
-            id=self.total_events,
-            file_name=file_name,
-            function_name=func_name,
-            line_no=line_no,
-            # We substract the overhead to simulate a raw run without tracing
-            start_time=now - self.overhead,
-            stack_trace=self.call_stack.copy(),
-        )
-        if line_no not in ["END_OF_FRAME", 0]:
-            # In this case the line is not a real line of code so it can't be a parent to any other line
-            self.tempo_line_infos = (file_name, func_name, line_no)
-        self.total_events += 1
-
-    def _handle_return(self, code: CodeType, instruction_offset: int, retval: object):
+        if _DEBUG:
+            logger.debug("tracing line: %s %s %s", file_name, func_name, line_no)
+        self._add_line_event(file_name, func_name, line_no, now, self.call_stack)
+        if line_no != 0:
+            # Line 0 is not a real line of code so it can't be a parent to any other line
+            # (line numbers from sys.monitoring are ints, never END_OF_FRAME)
+            self.tempo_line_infos = line_key
+
+    def _handle_return(
+        self, code: CodeType, instruction_offset: int, retval: object
+    ) -> object:
         """Handle function return events"""
-        now = time.perf_counter()
+        code_infos = self._code_infos.get(id(code))
+        if code_infos is None:
+            code_infos = self._add_code_infos(code)
+        _, is_user_code, _ = code_infos
+
+        # Skip if not user code
+        if not is_user_code:
+            return sys.monitoring.DISABLE
 
+        now = perf_counter_ns()
         file_name = code.co_filename
         func_name = code.co_name
         line_no = code.co_firstlineno
-
-        # Skip if not user code
-        if not self._is_user_code(file_name):
-            self.overhead += time.perf_counter() - now
-            return sys.monitoring.DISABLE
-        logging.debug(f"Returning from {func_name} in {file_name} ({line_no})")
+        if _DEBUG:
+            logger.debug("Returning from %s in %s (%s)", func_name, file_name, line_no)
 
         # In case the stop_tracing is called from a lower frame than start_tracing,
         # we need to activate monitoring for the returned frame
-        current_frame = sys._getframe().f_back
-        if not sys.monitoring.get_tool(self.tool_id):
-            sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
-        # We check if the returned frame already exists, if yes we activate monitoring for it
-        if current_frame and current_frame.f_back and current_frame.f_back.f_code:
-            sys.monitoring.set_local_events(
-                self.tool_id,
-                current_frame.f_code,
-                sys.monitoring.events.LINE
-                | sys.monitoring.events.PY_RETURN
-                | sys.monitoring.events.PY_START,
-            )
+        # PY_RETURN is a local event, so the returning code object is almost always one we
+        # already instrumented, in which case there is nothing to do
+        if id(code) not in self._instrumented_codes:
+            current_frame = sys._getframe(1)
+            if not sys.monitoring.get_tool(self.tool_id):
+                sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
+            # We check if the returned frame already exists, if yes we activate monitoring for it
+            if current_frame and current_frame.f_back and current_frame.f_back.f_code:
+                sys.monitoring.set_local_events(
+                    self.tool_id,
+                    current_frame.f_code,
+                    sys.monitoring.events.LINE
+                    | sys.monitoring.events.PY_RETURN
+                    | sys.monitoring.events.PY_START
+                    | sys.monitoring.events.PY_YIELD
+                    | sys.monitoring.events.PY_RESUME,
+                )
+                self._instrumented_codes[id(current_frame.f_code)] = (
+                    current_frame.f_code
+                )
 
         # Adding a END_OF_FRAME event to the tree to mark the end of the frame
         # This is used to compute the duration of the last line of the frame
-        self.tree.add_line_event(
-            id=self.total_events,
-            file_name=file_name,
-            function_name=func_name,
-            line_no="END_OF_FRAME",
-            start_time=now - self.overhead,
-            stack_trace=self.call_stack.copy(),
-        )
+        self._add_line_event(file_name, func_name, "END_OF_FRAME", now, self.call_stack)
 
         # A function is returning
         # We just need to pop the last line from the call stack so next
         # lines will have the correct parent
-        if self.call_stack:
-            self.call_stack.pop()
-
-        self.total_events += 1
+        # Generator expressions don't push an entry when they start or are resumed, but they
+        # yield and end with PY_RETURN or, when closed early (e.g. by any()), with PY_UNWIND
+        if self._pushing_codes and self._pushing_codes[-1] is code:
+            self._pushing_codes.pop()
+            call_stack = self.call_stack[:-1]
+            self.call_stack = self._stack_cache.setdefault(call_stack, call_stack)
+
+    def _handle_unwind(
+        self, code: CodeType, instruction_offset: int, exception: BaseException
+    ) -> None:
+        """Handle function exit by an exception"""
+        # PY_UNWIND is a global event that can't be disabled, so it is delivered for every frame
+        # an exception goes through, we only handle the frames of the code objects we monitor
+        # Without it the call stack would not be popped and the next lines of the caller would
+        # be recorded as children of the line that called the function
+        if id(code) not in self._instrumented_codes:
+            return
+        self._handle_return(code, instruction_offset, exception)
 
     def start_tracing(self) -> None:
         # Reset state
@@ -188,47 +306,84 @@ class CodeMonitor:
         sys.monitoring.register_callback(
             self.tool_id, sys.monitoring.events.PY_RETURN, self._handle_return
         )
+        sys.monitoring.register_callback(
+            self.tool_id, sys.monitoring.events.PY_UNWIND, self._handle_unwind
+        )
+        # A generator leaves its frame when it yields and enters it again when it is resumed,
+        # possibly from another line or after its caller returned, so these are handled as a
+        # return and a call to give back the call stack entry while the generator is suspended
+        sys.monitoring.register_callback(
+            self.tool_id, sys.monitoring.events.PY_YIELD, self._handle_return
+        )
+        sys.monitoring.register_callback(
+            self.tool_id, sys.monitoring.events.PY_RESUME, self._handle_call
+        )
 
-        # 2 f_back to get out of the "start_tracing" function stack and get the user code frame
-        current_frame = sys._getframe().f_back.f_back
+        # Depth 2 to get out of the "start_tracing" function stack and get the user code frame
+        current_frame = sys._getframe(2)
 
         # The idea is that we register for calls at global level to not miss future calls and we register
         # for lines at the current frame (take care of set_local so it can be removed)
-        sys.monitoring.set_events(self.tool_id, sys.monitoring.events.PY_START)
+        # PY_UNWIND can't be set locally, it is global and filtered in its callback
+        sys.monitoring.set_events(
+            self.tool_id,
+            sys.monitoring.events.PY_START | sys.monitoring.events.PY_UNWIND,
+        )
         sys.monitoring.set_local_events(
             self.tool_id,
             current_frame.f_code,
             sys.monitoring.events.LINE | sys.monitoring.events.PY_RETURN,
         )
-        logging.debug("Tracing started")
+        self._instrumented_codes[id(current_frame.f_code)] = current_frame.f_code
+        logger.debug("Tracing started")
 
     def stop_tracing(self) -> None:
+        if not sys.monitoring.get_tool(self.tool_id):
+            sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
         # Turn off monitoring for our tool
         sys.monitoring.set_events(self.tool_id, 0)
+        # Clear the local events of every code object we instrumented, otherwise
+        # CPython keeps them instrumented after the tracing is stopped
+        for code in self._instrumented_codes.values():
+            sys.monitoring.set_local_events(self.tool_id, code, 0)
         current_frame = sys._getframe()
         while current_frame:
-            if not sys.monitoring.get_tool(self.tool_id):
-                sys.monitoring.use_tool_id(self.tool_id, "lblprof-monitor")
-                sys.monitoring.set_events(self.tool_id, 0)
             sys.monitoring.set_local_events(self.tool_id, current_frame.f_code, 0)
-            sys.monitoring.free_tool_id(self.tool_id)
             current_frame = current_frame.f_back
+        # Unregister our callbacks so sys.monitoring doesn't keep the monitor (and its tree)
+        # alive after the tracing, free_tool_id doesn't clear them on Python 3.12
+        for event in (
+            sys.monitoring.events.PY_START,
+            sys.monitoring.events.LINE,
+            sys.monitoring.events.PY_RETURN,
+            sys.monitoring.events.PY_UNWIND,
+            sys.monitoring.events.PY_YIELD,
+            sys.monitoring.events.PY_RESUME,
+        ):
+            sys.monitoring.register_callback(self.tool_id, event, None)
+        sys.monitoring.free_tool_id(self.tool_id)
+
+    def _add_code_infos(
+        self, code: CodeType
+    ) -> Tuple[CodeType, bool, Dict[int, Tuple[str, str, int]]]:
+        """Compute and cache the infos of a code object seen for the first time."""
+        # The stop_tracing functions are handled like non user code, so their events are never
+        # recorded, this is checked once per code object instead of once per event
+        is_user_code = "stop_tracing" not in code.co_name and self._is_user_code(
+            code.co_filename
+        )
+        code_infos = (code, is_user_code, {})
+        self._code_infos[id(code)] = code_infos
+        return code_infos
 
     def _is_user_code(self, filename: str) -> bool:
         """Check if a file belongs to an installed module rather than user code.
         This is used to determine if we want to trace a line or not"""
-
-        if (
-            ".local/lib" in filename
-            or "/usr/lib" in filename
-            or "/usr/local/lib" in filename
-            or "site-packages" in filename
-            or "dist-packages" in filename
-            or "/lib/python3.12/" in filename
-            or "frozen" in filename
-            or ".local/share" in filename
-            or "/.vscode-server/" in filename
-            or filename.startswith("<")
-        ):
-            return False
-        return True
+        is_user_code = self._user_code_cache.get(filename)
+        if is_user_code is None:
+            is_user_code = not (
+                filename.startswith(_NON_USER_CODE_PREFIXES)
+                or _NON_USER_CODE_RE.search(filename)
+            )
+            self._user_code_cache[filename] = is_user_code
+        return is_user_code
@@ -1,53 +1,33 @@
-from typing import List, Literal, NamedTuple, Tuple, Optional, Union
+from typing import Dict, Literal, Tuple, Optional, Union
 
-from pydantic import BaseModel, Field, ConfigDict
+from dataclasses import dataclass, field
 
 
-class LineKey(NamedTuple):
-    file_name: str
-    function_name: str
-    line_no: Union[int, Literal["END_OF_FRAME"]]
-
+@dataclass(slots=True, kw_only=True)
+class LineStats:
+    """Statistics for a single line of code."""
 
-class LineEvent(NamedTuple):
+    # Unique identifier for this line
     id: int
+
+    # Key infos
+    # File and function containing this line, and line number in the source file
     file_name: str
     function_name: str
     line_no: Union[int, Literal["END_OF_FRAME"]]
-    start_time: float
-    stack_trace: list[Tuple[str, str, int]]
-
-
-class LineStats(BaseModel):
-    """Statistics for a single line of code."""
-
-    model_config = ConfigDict(validate_assignment=True)
-
-    id: int = Field(..., ge=0, description="Unique identifier for this line")
-
-    # Key infos
-    file_name: str = Field(..., min_length=1, description="File containing this line")
-    function_name: str = Field(
-        ..., min_length=1, description="Function containing this line"
-    )
-    line_no: Union[int, Literal["END_OF_FRAME"]] = Field(
-        ..., description="Line number in the source file"
-    )
-    stack_trace: List[Tuple[str, str, int]] = Field(
-        default_factory=list, description="Stack trace for this line"
-    )
+    # Stack trace for this line
+    stack_trace: Tuple[Tuple[str, str, int], ...] = ()
 
     # Stats
-    start_time: float = Field(
-        ..., ge=0, description="Time when this line was first executed"
-    )
-    hits: int = Field(..., ge=0, description="Number of times this line was executed")
-    time: float = Field(
-        description="Time spent on this line in milliseconds", default=0
-    )
+    # Time when this line was first executed, in nanoseconds (perf_counter_ns)
+    start_time: int
+    # Number of times this line was executed
+    hits: int
+    # Time spent on this line in seconds
+    time: float = 0
 
-    # Source code
-    source: str = Field(..., min_length=1, description="Source code for this line")
+    # Source code for this line
+    source: str
 
     # Parent line that called this function
     # If None then it
@@ -56,24 +36,27 @@ class LineStats(BaseModel):
     # Children lines called by this line (populated during analysis)
     # We use a dict because it alows us to remove some childs in O(1) time
     # We need to remove children when we merge duplicated and when we remove END_OF_FRAME events
-    childs: dict[int, "LineStats"] = Field(default_factory=dict)
+    childs: Dict[int, "LineStats"] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        self._validate()
+
+    def _validate(self) -> None:
+        """Check the constraints on the fields when the line is created."""
+        if self.id < 0:
+            raise ValueError(f"id must be >= 0, got {self.id}")
+        if not self.file_name:
+            raise ValueError("file_name must not be empty")
+        if not self.function_name:
+            raise ValueError("function_name must not be empty")
+        if self.start_time < 0:
+            raise ValueError(f"start_time must be >= 0, got {self.start_time}")
+        if self.hits < 0:
+            raise ValueError(f"hits must be >= 0, got {self.hits}")
+        if not self.source:
+            raise ValueError("source must not be empty")
 
     @property
     def event_id(self) -> int:
         """Get the unique id for this line."""
         return self.id
-
-    @property
-    def event_key(self) -> Tuple[LineKey, Tuple[LineKey, ...]]:
-        """Get the unique key for the event."""
-        return (
-            LineKey(
-                file_name=self.file_name,
-                function_name=self.function_name,
-                line_no=self.line_no,
-            ),
-            tuple(
-                LineKey(file_name=frame[0], function_name=frame[1], line_no=frame[2])
-                for frame in self.stack_trace
-            ),
-        )
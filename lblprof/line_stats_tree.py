@@ -1,8 +1,14 @@
+import csv
+import linecache
+from array import array
 import logging
 import os
-from typing import List, Dict, Literal, Tuple, Optional, Union
+from typing import Iterable, List, Dict, Literal, Tuple, Optional, Union
+from lblprof._config import _DEBUG
 from lblprof.curses_ui import TerminalTreeUI
-from lblprof.line_stat_object import LineStats, LineKey, LineEvent
+from lblprof.line_stat_object import LineStats
+
+logger = logging.getLogger(__name__)
 
 
 class LineStatsTree:
@@ -10,180 +16,200 @@ class LineStatsTree:
 
     def __init__(self):
         # just raw event from custom_tracer
-        # Inserting in this list should be as fast as possible to avoid overhead
-        self.raw_events_list: List[LineEvent] = []
+        # Inserting should be as fast as possible to avoid overhead, so the events are stored
+        # as parallel columns (one entry per event) instead of one object per event
+        # The id of an event is its index in the columns
+        self.raw_file_names: List[str] = []
+        self.raw_function_names: List[str] = []
+        self.raw_line_nos: List[Union[int, Literal["END_OF_FRAME"]]] = []
+        self.raw_start_times = array("q")
+        self.raw_stack_traces: List[Tuple[Tuple[str, str, int], ...]] = []
 
         # Index of events by id
         self.events_index: Dict[int, LineStats] = {}
 
+        # Base name of each file name, displayed for every line of the tree
+        self._basenames: Dict[str, str] = {}
+
         # Track root nodes (lines of user code initial frame)
         self.root_lines: List[LineStats] = []
 
-        # cache of source code for lines
-        # key is (file_name, line_no) for a source code line
-        self.line_source: Dict[Tuple[str, int], str] = {}
-
     def add_line_event(
         self,
-        id: int,
         file_name: str,
         function_name: str,
         line_no: Union[int, Literal["END_OF_FRAME"]],
-        start_time: float,
-        stack_trace: List[Tuple[str, str, int]],
+        start_time: int,
+        stack_trace: Tuple[Tuple[str, str, int], ...],
     ) -> None:
-        """Add a line event to the tree."""
-        # We don't want to add events from stop_tracing function
-        # We might want something cleaner ?
-        if "stop_tracing" in function_name:
-            return
-
-        logging.debug(
-            f"Adding line event: {file_name}::{function_name}::{line_no} at {start_time}::{stack_trace}"
-        )
+        """Add a line event to the tree, start_time is in nanoseconds (perf_counter_ns)."""
+        if _DEBUG:
+            logger.debug(
+                "Adding line event: %s::%s::%s at %s::%s",
+                file_name,
+                function_name,
+                line_no,
+                start_time,
+                stack_trace,
+            )
 
-        self.raw_events_list.append(
-            {
-                "id": id,
-                "file_name": file_name,
-                "function_name": function_name,
-                "line_no": line_no,
-                "start_time": start_time,
-                "stack_trace": stack_trace,
-            }
-        )
+        self.raw_file_names.append(file_name)
+        self.raw_function_names.append(function_name)
+        self.raw_line_nos.append(line_no)
+        self.raw_start_times.append(start_time)
+        self.raw_stack_traces.append(stack_trace)
 
     def build_tree(self) -> None:
         """Build the tree (self.events_index) from the raw events list."""
 
-        # 1. Build the events index (id: LineStats)
-        for event in self.raw_events_list:
-            source = self._get_source_code(event["file_name"], event["line_no"])
+        # 1. Build the events index (id: LineStats) in a single pass over the raw events
+        # For each event we link it to its parent and set the duration of the previous line of its frame
+        # We map each line key (file_name, function_name, line_no) to the id of its first event,
+        # so we can get the parent_id in O(1) time for each line
+        # We always prefer that the parent of a line is the first event corresponding to the parent line
+        linekey_to_id: Dict[Tuple[str, str, Union[int, str]], int] = {}
+        # We also give an integer id to each distinct stack trace, so the merge of step 2 hashes
+        # and compares a small int instead of walking the whole stack for every event
+        # Consecutive events mostly share the same stack tuple object, so we check it first
+        stack_ids: Dict[Tuple[Tuple[str, str, int], ...], int] = {}
+        event_stack_ids: List[int] = []
+        last_stack_trace = None
+        last_stack_id = -1
+        # Source of each distinct line, so it is resolved (and checked for stop_tracing) once per line
+        # instead of once per event
+        line_sources: Dict[Tuple[str, Union[int, str]], str] = {}
+        # we use the time_save dict to store the id and start time of the previous line in the same frame (which is not necessary the previous line in the index)
+        # start times are integer nanoseconds from perf_counter_ns, the durations are converted to seconds
+        time_save: Dict[Union[int, None], Tuple[int, int]] = {}
+        # The id of an event is its position in the raw events columns
+        for event_id, (
+            file_name,
+            function_name,
+            line_no,
+            start_time,
+            stack_trace,
+        ) in enumerate(
+            zip(
+                self.raw_file_names,
+                self.raw_function_names,
+                self.raw_line_nos,
+                self.raw_start_times,
+                self.raw_stack_traces,
+            )
+        ):
+            source = line_sources.get((file_name, line_no))
+            if source is None:
+                source = self._get_source_code(file_name, line_no)
+                line_sources[(file_name, line_no)] = source
             if "stop_tracing" in source:
                 # This allow to delete the call to stop_tracing from the tree
                 # and set the end line for the root lines
-                event["line_no"] = "END_OF_FRAME"
-
-            event_key = event["id"]
-            if event_key not in self.events_index:
-                self.events_index[event_key] = LineStats(
-                    id=event["id"],
-                    file_name=event["file_name"],
-                    function_name=event["function_name"],
-                    line_no=event["line_no"],
-                    stack_trace=event["stack_trace"],
-                    start_time=event["start_time"],
-                    hits=1,
-                    source=source,
-                )
-            else:
-                raise Exception("Event key already in self.events_index")
-
-        # 2. Establish parent-child relationships
-        # We first build a dict to map event keys to event ids, so we can get the parent_id in O(1) time for each line
-        # we reverse the list because we always prefer that the parent of a line is the first event corresponding to the parent line
-        linekey_to_id = {
-            line.event_key[0]: event_id
-            for event_id, line in reversed(list(self.events_index.items()))
-        }
-        for id, event in self.events_index.items():
-
-            # We get parent from stack trace
-            if len(event.stack_trace) == 0:
+                line_no = "END_OF_FRAME"
+
+            if stack_trace is not last_stack_trace:
+                last_stack_trace = stack_trace
+                last_stack_id = stack_ids.setdefault(tuple(stack_trace), len(stack_ids))
+            event_stack_ids.append(last_stack_id)
+
+            # Find the parent from the stack trace
+            # The caller line is always recorded before the lines of the frame it calls,
+            # so the parent is already in the index
+            if len(stack_trace) == 0:
                 # we are in a root line
-                self.root_lines.append(event)
+                parent_id = None
+            else:
+                # the last frame of the stack trace is the (file_name, function_name, line_no) of the parent
+                parent_id = linekey_to_id.get(stack_trace[-1])
+                if parent_id is None:
+                    raise Exception(
+                        f"Parent key {stack_trace[-1]} not found in events index"
+                    )
+
+            # The previous line of the frame ends when this event starts
+            previous = time_save.get(parent_id)
+            if previous is not None:
+                previous_id, previous_start_time = previous
+                if start_time - previous_start_time < 0:
+                    logger.warning(
+                        "Time of line %s is negative: %s - %s",
+                        previous_id,
+                        start_time,
+                        previous_start_time,
+                    )
+                self.events_index[previous_id].time = (
+                    start_time - previous_start_time
+                ) / 1e9
+
+            if line_no == "END_OF_FRAME":
+                # END_OF_FRAME events only mark the end of the last line of a frame,
+                # they are not lines of the tree
+                time_save.pop(parent_id, None)
                 continue
 
-            # find id of the parent in self.events_index
-            parent_key = LineKey(
-                file_name=event.stack_trace[-1][0],
-                function_name=event.stack_trace[-1][1],
-                line_no=event.stack_trace[-1][2],
+            event = LineStats(
+                id=event_id,
+                file_name=file_name,
+                function_name=function_name,
+                line_no=line_no,
+                stack_trace=stack_trace,
+                start_time=start_time,
+                hits=1,
+                source=source,
+                parent=parent_id,
             )
-            parent_id = linekey_to_id.get(parent_key)
+            self.events_index[event_id] = event
+            linekey_to_id.setdefault((file_name, function_name, line_no), event_id)
+            time_save[parent_id] = (event_id, start_time)
             if parent_id is None:
-                raise Exception(
-                    f"Parent key {event.stack_trace[-1]} not found in events index"
-                )
+                self.root_lines.append(event)
+            else:
+                self.events_index[parent_id].childs[event_id] = event
 
-            self.events_index[parent_id].childs[id] = event
-            event.parent = parent_id
-            self.events_index[id] = event
+        # The raw events are not needed anymore, free them before building the rest of the tree
+        self.raw_file_names = []
+        self.raw_function_names = []
+        self.raw_line_nos = []
+        self.raw_start_times = array("q")
+        self.raw_stack_traces = []
 
-        # 3. Update duration of each line
-        # we use the time_save dict to store the id and start time of the previous line in the same frame (which is not necessary the previous line in the index)
-        time_save: Dict[Union[int, None], Tuple[int, float]] = {}
-        for id, event in self.events_index.items():
-            if event.parent not in time_save:
-                # first line of the frame
-                time_save[event.parent] = (id, event.start_time)
-                continue
-            # not the first line of the frame, update the time of the previous line
-            previous_id, previous_start_time = time_save[event.parent]
-            if event.start_time - previous_start_time < 0:
-                logging.warning(
-                    f"Time of line {event.id} is negative: {event.start_time} - {previous_start_time}"
-                )
-            self.events_index[previous_id].time = event.start_time - previous_start_time
-            time_save[event.parent] = (id, event.start_time)
-
-        # 4. Remove END_OF_FRAME lines
-        # The END_OF_FRAME lines are not needed in the tree anymore
-        for id, event in list(self.events_index.items()):
-            if event.line_no == "END_OF_FRAME":
-                parent_id = event.parent
-                if parent_id is not None:
-                    del self.events_index[parent_id].childs[id]
-                del self.events_index[id]
-        self.root_lines = [
-            line for line in self.events_index.values() if line.parent is None
-        ]
-
-        # 5. Merge lines that have same file_name, function_name and line_no (to avoid duplicates in a for loop for example)
+        # 2. Merge lines that have same file_name, function_name and line_no (to avoid duplicates in a for loop for example)
         # Not it is important to start by root nodes and merge going down the tree (DFS pre-order)
-        grouped_events = {}
-
-        def _merge(event: LineStats):
-            """Merge events that have same file_name, function_name and line_no in the same frame."""
+        # We use an explicit stack instead of recursion so deep call trees don't hit the recursion limit,
+        # children are pushed in reverse order so they are popped in the same order as a recursive traversal
+        # The merged duplicates are removed from the index and from their parent childs as we go,
+        # so the tree doesn't need to be rebuilt afterwards
+        grouped_events: Dict[Tuple[str, str, Union[int, str], int], LineStats] = {}
+        root_lines: List[LineStats] = []
+        stack = list(reversed(self.root_lines))
+        while stack:
+            event = stack.pop()
+            # Merge events that have same file_name, function_name and line_no in the same frame
             key = (
                 event.file_name,
                 event.function_name,
                 event.line_no,
-                tuple(event.stack_trace),
+                event_stack_ids[event.id],
             )
-            if key not in grouped_events:
-                grouped_events[key] = event
+            grouped = grouped_events.setdefault(key, event)
+            if grouped is event:
+                if event.parent is None:
+                    root_lines.append(event)
             else:
-                grouped = grouped_events[key]
                 grouped.time += event.time
                 grouped.hits += event.hits
                 grouped.childs.update(event.childs)
                 # update parent of the new children
                 for child in event.childs.values():
                     child.parent = grouped.id
+                # The parent of a duplicate is already merged, so it is the one that holds it in its childs
+                del self.events_index[event.id]
+                if event.parent is not None:
+                    del self.events_index[event.parent].childs[event.id]
+
+            # Now visit the children
+            stack.extend(reversed(event.childs.values()))
 
-            # Now recurse on the children
-            for child in event.childs.values():
-                _merge(child)
-
-        for event in self.root_lines:
-            _merge(event)
-
-        # 6. Update the events_index with the merged events
-        self.events_index = {}
-        for key, event in grouped_events.items():
-            self.events_index[event.id] = event
-
-        # 7. Update the childs attributes to remove deleted childs
-        for id, event in self.events_index.items():
-            event.childs = {
-                child.id: child
-                for child in event.childs.values()
-                if child.id in self.events_index
-            }
-        self.root_lines = [
-            line for line in self.events_index.values() if line.parent is None
-        ]
+        self.root_lines = root_lines
 
     # --------------------------------
     # Display methods
@@ -199,71 +225,18 @@ class LineStatsTree:
         prefix: str = "",
     ) -> None:
         """Display a visual tree showing parent-child relationships between lines."""
-        if depth > max_depth:
-            return  # Prevent infinite recursion
-
         # Tree branch characters
         branch_mid = "├── "
         branch_last = "└── "
         pipe = "│   "
         space = "    "
 
-        def format_line_info(line: LineStats, branch: str):
-            filename = os.path.basename(line.file_name)
-            line_id = f"{filename}::{line.function_name}::{line.line_no}"
-
-            # Truncate source code
-            truncated_source = (
-                line.source[:60] + "..." if len(line.source) > 60 else line.source
-            )
-
-            # Display line with time info and hits count
-            assert line.time is not None
-            return f"{prefix}{branch}{line_id} [hits:{line.hits} total:{line.time*1000:.2f}ms] - {truncated_source}"
-
-        def group_children_by_file(
-            children: dict[int, LineStats],
-        ) -> Dict[str, List[LineStats]]:
-            children_by_file = {}
-            for child in children.values():
-                if child.file_name not in children_by_file:
-                    children_by_file[child.file_name] = []
-                children_by_file[child.file_name].append(child)
-
-            # Sort each file's lines by line number
-            for file_name in children_by_file:
-                children_by_file[file_name].sort(key=lambda x: x.line_no)
-
-            return children_by_file
-
-        def get_all_children(
-            children_by_file: Dict[str, List[LineStats]],
-        ) -> List[LineStats]:
-            all_children = []
-            for file_name in children_by_file:
-                all_children.extend(children_by_file[file_name])
-            return all_children
-
-        if root_key:
-
-            line = self.events_index[root_key]
-            branch = branch_last if is_last else branch_mid
-            print(format_line_info(line, branch))
-
-            # Get all child lines
-            child_lines = line.childs
-
-            # Group and organize children
-            children_by_file = group_children_by_file(child_lines)
-            all_children = get_all_children(children_by_file)
-
-            # Display child lines in order
-            next_prefix = prefix + (space if is_last else pipe)
-            for i, child in enumerate(all_children):
-                is_last_child = i == len(all_children) - 1
-                self.display_tree(
-                    child.id, depth + 1, max_depth, is_last_child, next_prefix
-                )
+        # Lines to display, as (line, depth, is_last, prefix)
+        # We use an explicit stack instead of recursion, the children of a line are pushed
+        # in reverse order so they are displayed in order (DFS pre-order)
+        stack: List[Tuple[LineStats, int, bool, str]] = []
+        if root_key is not None:
+            stack.append((self.events_index[root_key], depth, is_last, prefix))
         else:
             # Print all root trees
             root_lines = self.root_lines
@@ -280,23 +253,25 @@ class LineStatsTree:
             )
 
             # For each root, render as a separate tree
-            for i, root in enumerate(root_lines):
-                is_last_root = i == len(root_lines) - 1
-                branch = branch_last if is_last_root else branch_mid
-
-                print(format_line_info(root, branch))
-
-                # Get all child lines and organize them
-                children_by_file = group_children_by_file(root.childs)
-                all_children = get_all_children(children_by_file)
-
-                # Display child lines in order
-                next_prefix = space if is_last_root else pipe
-                for j, child in enumerate(all_children):
-                    is_last_child = j == len(all_children) - 1
-                    self.display_tree(
-                        child.id, 1, max_depth, is_last_child, next_prefix
-                    )
+            for i in reversed(range(len(root_lines))):
+                stack.append((root_lines[i], 0, i == len(root_lines) - 1, ""))
+
+        while stack:
+            line, depth, is_last, prefix = stack.pop()
+            if depth > max_depth:
+                continue  # Lines deeper than max_depth are not displayed
+
+            branch = branch_last if is_last else branch_mid
+            print(self._format_line_info(line, prefix, branch))
+
+            # Get all child lines, grouped by file and sorted by line number
+            all_children = self._sort_children(line.childs.values())
+
+            # Display child lines in order
+            next_prefix = prefix + (space if is_last else pipe)
+            for i in reversed(range(len(all_children))):
+                is_last_child = i == len(all_children) - 1
+                stack.append((all_children[i], depth + 1, is_last_child, next_prefix))
 
     def show_interactive(self, min_time_s: float = 0.1):
         """Display the tree in an interactive terminal interface."""
@@ -321,21 +296,30 @@ class LineStatsTree:
 
         # Define the node formatter function
         # Given a line, return its formatted string (displayed in the UI)
+        # The tree doesn't change once built, so the text of each line is formatted only
+        # once and reused on every redraw, only the indicator depends on the UI state
+        formatted_lines: Dict[int, str] = {}
+
         def format_node(line: LineStats, indicator: str = "") -> str:
-            filename = os.path.basename(line.file_name)
-            line_id = f"{filename}::{line.function_name}::{line.line_no}"
+            text = formatted_lines.get(line.id)
+            if text is None:
+                filename = self._get_basename(line.file_name)
+                line_id = f"{filename}::{line.function_name}::{line.line_no}"
+
+                # Truncate source code
+                truncated_source = (
+                    line.source[:40] + "..." if len(line.source) > 40 else line.source
+                )
 
-            # Truncate source code
-            truncated_source = (
-                line.source[:40] + "..." if len(line.source) > 40 else line.source
-            )
+                # Format stats
+                assert line.time is not None
+                stats = f"[hits:{line.hits} time:{line.time:.2f}s]"
 
-            # Format stats
-            assert line.time is not None
-            stats = f"[hits:{line.hits} time:{line.time:.2f}s]"
+                text = f"{line_id} {stats} - {truncated_source}"
+                formatted_lines[line.id] = text
 
             # Return formatted line
-            return f"{indicator}{line_id} {stats} - {truncated_source}"
+            return f"{indicator}{text}"
 
         # Create and run the UI
         ui = TerminalTreeUI(get_tree_data, format_node)
@@ -345,20 +329,91 @@ class LineStatsTree:
     # Private methods
     # --------------------------------
     def _save_events(self) -> None:
-        """Save the events to a file."""
-        with open("events.csv", "w") as f:
-            for event in self.raw_events_list:
-                f.write(
-                    f"{event['id']},{event['file_name']},{event['function_name']},{event['line_no']},{event['start_time']},{event['stack_trace']}\n"
+        """Save the events to a file (debug helper, never called while tracing)."""
+        # The events recorded under the same call stack share the same stack tuple,
+        # so each distinct stack is formatted once, keyed by the identity of its tuple
+        stack_strs: Dict[int, str] = {}
+
+        def format_stack(stack_trace: Tuple[Tuple[str, str, int], ...]) -> str:
+            stack_str = stack_strs.get(id(stack_trace))
+            if stack_str is None:
+                stack_str = str(stack_trace)
+                stack_strs[id(stack_trace)] = stack_str
+            return stack_str
+
+        with open("events.csv", "w", newline="", buffering=1 << 20) as f:
+            csv.writer(f).writerows(
+                (id, file_name, function_name, line_no, start_time, format_stack(stack))
+                for id, (
+                    file_name,
+                    function_name,
+                    line_no,
+                    start_time,
+                    stack,
+                ) in enumerate(
+                    zip(
+                        self.raw_file_names,
+                        self.raw_function_names,
+                        self.raw_line_nos,
+                        self.raw_start_times,
+                        self.raw_stack_traces,
+                    )
                 )
+            )
 
     def _save_events_index(self) -> None:
-        """Save the events index to a file."""
-        with open("events_index.csv", "w") as f:
-            for key, event in self.events_index.items():
-                f.write(
-                    f"{event.id},{event.file_name.split('/')[-1]},{event.function_name},{event.line_no},{event.source},{event.hits},{event.start_time},{event.time},{len(event.childs)},{event.parent}\n"
+        """Save the events index to a file (debug helper, never called while tracing)."""
+        with open("events_index.csv", "w", newline="", buffering=1 << 20) as f:
+            csv.writer(f).writerows(
+                (
+                    event.id,
+                    self._get_basename(event.file_name),
+                    event.function_name,
+                    event.line_no,
+                    event.source,
+                    event.hits,
+                    event.start_time,
+                    event.time,
+                    len(event.childs),
+                    event.parent,
                 )
+                for event in self.events_index.values()
+            )
+
+    def _format_line_info(self, line: LineStats, prefix: str, branch: str) -> str:
+        """Format a line of the tree printed by display_tree."""
+        filename = self._get_basename(line.file_name)
+        line_id = f"{filename}::{line.function_name}::{line.line_no}"
+
+        # Truncate source code
+        truncated_source = (
+            line.source[:60] + "..." if len(line.source) > 60 else line.source
+        )
+
+        # Display line with time info and hits count
+        assert line.time is not None
+        return f"{prefix}{branch}{line_id} [hits:{line.hits} total:{line.time*1000:.2f}ms] - {truncated_source}"
+
+    def _sort_children(self, children: Iterable[LineStats]) -> List[LineStats]:
+        """Sort lines by line number, grouped by file in order of first appearance."""
+        # A single stable sort on (file rank, line number), the rank of a file is its
+        # order of first appearance in the children
+        file_ranks: Dict[str, int] = {}
+        return sorted(
+            children,
+            key=lambda child: (
+                file_ranks.setdefault(child.file_name, len(file_ranks)),
+                child.line_no,
+            ),
+        )
+
+    def _get_basename(self, file_name: str) -> str:
+        """Get the base name of a file, computed once per file."""
+        basename = self._basenames.get(file_name)
+        if basename is None:
+            basename = os.path.basename(file_name)
+            self._basenames[file_name] = basename
+        return basename
 
     def _get_source_code(
         self, file_name: str, line_no: Union[int, Literal["END_OF_FRAME"]]
@@ -366,18 +421,7 @@ class LineStatsTree:
         """Get the source code for a specific line in a file."""
         if line_no == "END_OF_FRAME":
             return "END_OF_FRAME"
-        if (file_name, line_no) in self.line_source:
-            return self.line_source[(file_name, line_no)]
-        try:
-            with open(file_name, "r") as f:
-                lines = f.readlines()
-                if line_no - 1 < len(lines):
-                    source = lines[line_no - 1].strip()
-                    self.line_source[(file_name, line_no)] = source
-                    return source
-                else:
-                    return " "
-        except Exception as e:
-            return (
-                f"Error getting source code of line {line_no} in file {file_name}: {e}"
-            )
+        # linecache keeps the lines of each file in memory, so a file is read
+        # only once whatever the number of lines we need from it
+        # Out of range lines and files that can't be read give an empty line
+        return linecache.getline(file_name, line_no).strip() or " "
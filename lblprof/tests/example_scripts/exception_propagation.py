@@ -0,0 +1,23 @@
+import time
+
+
+def fail():
+    time.sleep(0.1)
+    raise ValueError("test")
+
+
+def main():
+    try:
+        fail()
+    except ValueError:
+        time.sleep(0.1)
+    time.sleep(0.1)
+
+
+if __name__ == "__main__":
+    try:
+        fail()
+    except ValueError:
+        pass
+    time.sleep(0.1)
+    main()
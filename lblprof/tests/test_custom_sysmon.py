@@ -0,0 +1,118 @@
+import os
+import pytest
+from lblprof import start_tracing, stop_tracing, tracer
+from lblprof.custom_sysmon import CodeMonitor
+
+
+@pytest.fixture
+def monitor():
+    """Fixture to create a CodeMonitor instance for each test."""
+    return CodeMonitor()
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "/home/user/.local/lib/python3.12/site-packages/pandas/__init__.py",
+        "/usr/lib/python3.12/json/__init__.py",
+        "/usr/local/lib/python3.12/runpy.py",
+        "/home/user/project/.venv/lib/python3.12/site-packages/numpy/core.py",
+        "/usr/lib/python3/dist-packages/requests/api.py",
+        "<frozen importlib._bootstrap>",
+        "<string>",
+        "/home/user/.vscode-server/extensions/debugpy/launcher.py",
+    ],
+)
+def test_is_not_user_code(monitor: CodeMonitor, filename: str):
+    """Installed and built-in modules should not be traced."""
+    assert not monitor._is_user_code(filename)
+
+
+def test_is_user_code(monitor: CodeMonitor):
+    """Files from the user project should be traced."""
+    assert monitor._is_user_code("/home/user/project/main.py")
+
+
+def test_is_not_user_code_interpreter_paths(monitor: CodeMonitor):
+    """Files from the running interpreter install should not be traced."""
+    assert not monitor._is_user_code(os.__file__)
+    assert not monitor._is_user_code(pytest.__file__)
+
+
+def _raise_error():
+    raise ValueError("test")
+
+
+def _catch_error():
+    try:
+        _raise_error()
+    except ValueError:
+        pass
+    after = 1
+    return after
+
+
+def _stop_genexpr_early():
+    found = any(c is not None for c in (1, None))
+    after = 1
+    return found, after
+
+
+def _traced_lines(func):
+    """Trace a call of func and return the lines recorded in func by their source."""
+    start_tracing()
+    func()
+    stop_tracing()
+    return {
+        line.source: line
+        for line in tracer.tree.events_index.values()
+        if line.function_name == func.__name__
+    }
+
+
+def test_lines_after_exception_are_siblings_of_the_call():
+    """The lines following a call that raised have the same parent as the call line."""
+    lines = _traced_lines(_catch_error)
+    call_line = lines["_raise_error()"]
+    assert lines["pass"].parent == call_line.parent
+    assert lines["after = 1"].parent == call_line.parent
+
+
+def test_lines_after_genexpr_stopped_early_are_siblings():
+    """A genexpr closed before its end (any() returning early) doesn't pop the call stack."""
+    lines = _traced_lines(_stop_genexpr_early)
+    genexpr_line = lines["found = any(c is not None for c in (1, None))"]
+    assert genexpr_line.parent is not None
+    assert lines["after = 1"].parent == genexpr_line.parent
+
+
+def _generator():
+    yield 1
+    yield 2
+
+
+def _start_generator():
+    generator = _generator()
+    next(generator)
+    return generator
+
+
+def _outlive_generator():
+    generator = _start_generator()
+    after = next(generator)
+    return after
+
+
+def test_generator_outliving_its_caller():
+    """A suspended generator gives back its call stack entry until it is resumed."""
+    lines = _traced_lines(_outlive_generator)
+    call_line = lines["generator = _start_generator()"]
+    resume_line = lines["after = next(generator)"]
+    assert resume_line.parent == call_line.parent
+    # The lines run after the resume are children of the line that resumed the generator
+    generator_lines = [
+        line
+        for line in tracer.tree.events_index.values()
+        if line.function_name == "_generator" and line.source == "yield 2"
+    ]
+    assert [line.parent for line in generator_lines] == [resume_line.id]
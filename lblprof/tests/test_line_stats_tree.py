@@ -1,4 +1,3 @@
-import os
 import pytest
 from lblprof.line_stats_tree import LineStatsTree
 
@@ -13,62 +12,53 @@ def test_add_line_event(tree: LineStatsTree):
     """Test adding a line event to the tree."""
     # Create a line with no parent (root line)
     tree.add_line_event(
-        id=1,
         file_name="test_file.py",
         function_name="test_function",
         line_no=10,
-        start_time=0.0,
+        start_time=0,
         stack_trace=[("test_file.py", "test_function", 10)],
     )
 
-    assert len(tree.raw_events_list) == 1
-    assert tree.raw_events_list[0]["id"] == 1
-    assert tree.raw_events_list[0]["file_name"] == "test_file.py"
-    assert tree.raw_events_list[0]["function_name"] == "test_function"
-    assert tree.raw_events_list[0]["line_no"] == 10
-    assert tree.raw_events_list[0]["start_time"] == 0.0
-    assert tree.raw_events_list[0]["stack_trace"] == [
-        ("test_file.py", "test_function", 10)
-    ]
+    assert len(tree.raw_file_names) == 1
+    assert tree.raw_file_names[0] == "test_file.py"
+    assert tree.raw_function_names[0] == "test_function"
+    assert tree.raw_line_nos[0] == 10
+    assert tree.raw_start_times[0] == 0
+    assert tree.raw_stack_traces[0] == [("test_file.py", "test_function", 10)]
 
 
 def test_add_line_event_with_parent(tree: LineStatsTree):
     """Test adding a line event with a parent in the tree."""
     # Create a parent line
     tree.add_line_event(
-        id=1,
         file_name="test_file.py",
         function_name="parent_function",
         line_no=5,
-        start_time=0.0,
+        start_time=0,
         stack_trace=[("test_file.py", "parent_function", 5)],
     )
 
     # Create a child line
     tree.add_line_event(
-        id=2,
         file_name="test_file.py",
         function_name="child_function",
         line_no=10,
-        start_time=0.0,
+        start_time=0,
         stack_trace=[("test_file.py", "child_function", 10)],
     )
 
     # Check that both lines were added to the tree
-    assert len(tree.raw_events_list) == 2
+    assert len(tree.raw_file_names) == 2
 
 
-def test_get_source_code(tree: LineStatsTree):
+def test_get_source_code(tree: LineStatsTree, tmp_path):
     """Test getting source code for a line."""
     # Create a temporary file
-    with open("temp_test_file.py", "w") as f:
-        f.write("def test_function():\n    print('Hello')\n")
+    source_file = tmp_path / "temp_test_file.py"
+    source_file.write_text("def test_function():\n    print('Hello')\n")
 
     # Get source code
-    source = tree._get_source_code("temp_test_file.py", 2)
+    source = tree._get_source_code(str(source_file), 2)
 
     # Check that the source code is correct
     assert source == "print('Hello')"
-
-    # Clean up
-    os.remove("temp_test_file.py")
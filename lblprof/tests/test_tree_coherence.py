@@ -1,5 +1,6 @@
 import runpy
 import os
+import re
 import pytest
 import logging
 
@@ -9,6 +10,9 @@ from lblprof import show_tree, start_tracing, stop_tracing, tracer
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Duration passed to a time.sleep call in a line of source code
+_SLEEP_RE = re.compile(r"time\.sleep\(([0-9.]+)\)")
+
 
 # It is hard to get reliable tests for some example of code, something that we
 # can do is to check that the tree is coherent
@@ -59,9 +63,9 @@ def _validate_parent_child_relations(tree: LineStatsTree):
 
 def _validate_time_sleep(tree: LineStatsTree):
     for line in tree.root_lines:
-        if "time.sleep" in line.source:
-            n = line.source.split("time.sleep(")[1].split(")")[0]
-            total_time = float(n) * line.hits * 1000
+        match = _SLEEP_RE.search(line.source)
+        if match:
+            total_time = float(match.group(1)) * line.hits * 1000
             assert line.time == pytest.approx(
                 total_time, rel=0.1
             ), f"Line {line.id} should have time {total_time} but has time {line.time}"